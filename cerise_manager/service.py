@@ -1,9 +1,6 @@
-import errno
-import os
 import random
-import requests
-import tarfile
-import tempfile
+import re
+import threading
 import time
 
 import docker
@@ -13,10 +10,240 @@ from cerise_manager import (
         ServiceAlreadyExists, PortNotAvailable, ServiceNotFound)
 
 
+# Docker connection
+
+_DOCKER_TIMEOUT = 600
+"""int: Timeout for Docker API calls, in seconds."""
+
+_docker_client = None
+
+
+def _get_docker_client():
+    """
+    Returns a Docker client shared by all functions in this module.
+
+    The client is created on first use, after which its connections
+    (and the API version negotiated with the daemon) are reused.
+
+    Returns:
+        docker.DockerClient: The shared client.
+    """
+    global _docker_client
+    if _docker_client is None:
+        _docker_client = docker.from_env(
+                version='auto', timeout=_DOCKER_TIMEOUT)
+    return _docker_client
+
+
+# Tracking which containers exist
+
+_known_containers = None
+"""set: Names of existing containers, or None if not tracking yet."""
+
+_known_containers_lock = threading.Lock()
+
+_services = {}
+"""dict: ManagedService objects handed out so far, by name."""
+
+
+def _track_containers(events):
+    """
+    Keeps _known_containers up to date from a Docker event stream.
+
+    Runs in a background thread. Cached ManagedService objects are
+    dropped when their container goes away. If the stream ends or
+    breaks, both caches are discarded, so that the next lookup starts
+    tracking anew.
+
+    Args:
+        events (generator): Decoded Docker container events.
+    """
+    global _known_containers
+    try:
+        for event in events:
+            action = event.get('Action')
+            attributes = event.get('Actor', {}).get('Attributes', {})
+            name = attributes.get('name')
+            with _known_containers_lock:
+                if action == 'create':
+                    _known_containers.add(name)
+                elif action == 'destroy':
+                    _known_containers.discard(name)
+                    _services.pop(name, None)
+                elif action == 'rename':
+                    old_name = attributes.get('oldName', '').lstrip('/')
+                    _known_containers.discard(old_name)
+                    _services.pop(old_name, None)
+                    _known_containers.add(name)
+    except Exception:
+        # Any failure of the stream, from docker, requests, urllib3 or
+        # http.client; the finally clause resets us for a new start.
+        pass
+    finally:
+        with _known_containers_lock:
+            _known_containers = None
+            _services.clear()
+
+
+def _get_known_containers():
+    """
+    Returns the set of names of existing containers.
+
+    On first use, this subscribes to Docker's container events and
+    then lists all containers, so that no changes are missed in
+    between. A background thread applies subsequent events. Any
+    ManagedService objects cached while nothing was tracking are
+    dropped, as their containers may have changed unnoticed.
+
+    Returns:
+        set: Names of the existing containers.
+    """
+    global _known_containers
+    with _known_containers_lock:
+        if _known_containers is None:
+            dc = _get_docker_client()
+            events = dc.events(decode=True, filters={'type': 'container'})
+            try:
+                listing = dc.api.containers(all=True)
+            except Exception:
+                events.close()
+                raise
+            _services.clear()
+            _known_containers = {
+                    container['Names'][0].lstrip('/')
+                    for container in listing}
+            threading.Thread(
+                    target=_track_containers, args=(events,),
+                    daemon=True).start()
+        return _known_containers
+
+
+def _remember_service(srv):
+    """
+    Adds a ManagedService to the cache used by get_service().
+
+    If the tracker has seen its container go away in the meantime,
+    the service is not cached.
+
+    Args:
+        srv (ManagedService): The service to remember.
+    """
+    with _known_containers_lock:
+        if _known_containers is None or srv._name in _known_containers:
+            _services[srv._name] = srv
+
+
+def _name_filter(srv_name):
+    """
+    Makes a Docker name filter that matches exactly one name.
+
+    Docker matches name filters as regular expressions, against the
+    name with or without a leading slash.
+
+    Args:
+        srv_name (str): Name of the container.
+
+    Returns:
+        str: A regular expression matching only that name.
+    """
+    return '^/?{}$'.format(re.escape(srv_name))
+
+
+def _container_exists(srv_name):
+    """
+    Asks the Docker daemon whether a container with this name exists.
+
+    Unlike service_exists(), this never answers from the cache, so it
+    is safe to use right after creating or removing a container.
+
+    Args:
+        srv_name (str): Name of the container.
+
+    Returns:
+        bool: True iff the container exists
+    """
+    dc = _get_docker_client()
+    return bool(dc.api.containers(
+            all=True, quiet=True, filters={'name': _name_filter(srv_name)}))
+
+
 # Creating and destroying services
 
 _RAND_RANGE=100
 
+_API_ERROR_MAP = (
+        ('address already in use', PortNotAvailable),
+        ('port is already allocated', PortNotAvailable),
+        ('Conflict. The container name', ServiceAlreadyExists))
+"""tuple: Pairs of Docker error message fragments and our exceptions."""
+
+_CREATE_SEMAPHORE = threading.BoundedSemaphore(10)
+"""threading.BoundedSemaphore: Limits concurrent container creation."""
+
+_START_TIMEOUT = 30
+"""int: How long to wait for a container to start, in seconds."""
+
+
+def _classify_api_error(error):
+    """
+    Finds which of our exceptions a Docker APIError corresponds to.
+
+    Bit clunky, but the message is all Docker gives us...
+
+    Args:
+        error (docker.errors.APIError): The error to classify.
+
+    Returns:
+        type: An exception class from _API_ERROR_MAP, or None if the
+            error is not one we know.
+    """
+    explanation = error.explanation or ''
+    for needle, exception in _API_ERROR_MAP:
+        if needle in explanation:
+            return exception
+    return None
+
+
+def _run_kwargs(srv_name, port, environment):
+    """
+    Builds the arguments to containers.run() for a service.
+
+    Args:
+        srv_name (str): Name of the service and its container.
+        port (int): The port to publish the service on, on localhost.
+        environment (dict): Environment variables independent of the
+            port.
+
+    Returns:
+        dict: Keyword arguments for containers.run().
+    """
+    environment = dict(environment)
+    environment['CERISE_STORE_LOCATION_CLIENT'] = (
+            'http://localhost:{}/files'.format(port))
+    return {
+            'name': srv_name,
+            'ports': {'29593/tcp': ('127.0.0.1', port)},
+            'environment': environment,
+            'detach': True}
+
+
+def _wait_for_start(container):
+    """
+    Waits until a container has finished starting, or _START_TIMEOUT.
+
+    Starting is finished when the container is running, or when it
+    has exited or died, e.g. because it crashed on startup.
+
+    Args:
+        container (docker.models.containers.Container): The container
+            to wait for, as last inspected after starting it.
+    """
+    deadline = time.monotonic() + _START_TIMEOUT
+    while (container.status in ('created', 'restarting') and
+            time.monotonic() < deadline):
+        time.sleep(0.05)
+        container.reload()
+
 
 def create_service(srv_name, srv_type, port=None, user_name=None, password=None):
     """
@@ -42,9 +269,9 @@ def create_service(srv_name, srv_type, port=None, user_name=None, password=None)
         ServiceAlreadyExists: A service with this name already exists.
         PortNotAvailable: The requested port is occupied.
     """
-    dc = docker.from_env()
+    dc = _get_docker_client()
 
-    if service_exists(srv_name):
+    if _container_exists(srv_name):
         raise ServiceAlreadyExists()
 
     auto_port = port is None
@@ -54,30 +281,21 @@ def create_service(srv_name, srv_type, port=None, user_name=None, password=None)
     if user_name == '':
         user_name = None
 
+    environment = {}
     if user_name is not None:
         environment['CERISE_USERNAME'] = user_name
     if password is not None:
         environment['CERISE_PASSWORD'] = password
 
-    environment = {}
-    while not service_exists(srv_name):
+    while not _container_exists(srv_name):
         try:
-            environment['CERISE_STORE_LOCATION_CLIENT'] = 'http://localhost:{}/files'.format(port)
-
-            dc.containers.run(
-                    srv_type,
-                    name=srv_name,
-                    ports={'29593/tcp': ('127.0.0.1', port) },
-                    environment=environment,
-                    detach=True)
-            container = dc.containers.get(srv_name)
-            while container.status == 'created':
-                time.sleep(0.05)
-                container.reload()
+            with _CREATE_SEMAPHORE:
+                container = dc.containers.run(
+                        srv_type, **_run_kwargs(srv_name, port, environment))
+            _wait_for_start(container)
         except docker.errors.APIError as e:
-            # Bit clunky, but it's all Docker gives us...
-            if ('address already in use' in e.explanation or
-                    'port is already allocated' in e.explanation):
+            error_type = _classify_api_error(e)
+            if error_type is PortNotAvailable:
                 # The container will already exist here, but be broken due to
                 # the port not being available. Remove it again first.
                 container = dc.containers.get(srv_name)
@@ -93,10 +311,15 @@ def create_service(srv_name, srv_type, port=None, user_name=None, password=None)
                     port += 1
                 else:
                     raise PortNotAvailable(e)
+            elif error_type is ServiceAlreadyExists:
+                # Created by someone else since we checked
+                raise ServiceAlreadyExists()
             else:
                 raise
 
-    return ManagedService(srv_name, port)
+    srv = ManagedService(srv_name, port)
+    _remember_service(srv)
+    return srv
 
 def destroy_service(srv):
     """
@@ -113,7 +336,7 @@ def destroy_service(srv):
     Raises:
         ServiceNotFound: A service with this name was not found.
     """
-    dc = docker.from_env()
+    dc = _get_docker_client()
     try:
         container = dc.containers.get(srv._name)
         container.stop()
@@ -121,6 +344,11 @@ def destroy_service(srv):
     except docker.errors.NotFound:
         raise ServiceNotFound()
 
+    with _known_containers_lock:
+        _services.pop(srv._name, None)
+        if _known_containers is not None:
+            _known_containers.discard(srv._name)
+
 def service_exists(srv_name):
     """
     Checks whether a managed service with the given name exists.
@@ -132,12 +360,10 @@ def service_exists(srv_name):
     Returns:
         bool: True iff the service exists
     """
-    dc = docker.from_env()
-    try:
-        dc.containers.get(srv_name)
+    if srv_name in _get_known_containers():
         return True
-    except docker.errors.NotFound:
-        return False
+    # The event stream may not have caught up yet, so check
+    return _container_exists(srv_name)
 
 def get_service(srv_name):
     """
@@ -153,14 +379,23 @@ def get_service(srv_name):
     Raises:
         ServiceNotFound: The requested service does not exist.
     """
-    if not service_exists(srv_name):
+    # service_exists() may start tracking, which empties the cache
+    if srv_name in _services and service_exists(srv_name):
+        srv = _services.get(srv_name)
+        if srv is not None:
+            return srv
+
+    dc = _get_docker_client()
+    try:
+        service = dc.containers.get(srv_name)
+    except docker.errors.NotFound:
         raise ServiceNotFound()
 
-    dc = docker.from_env()
-    service = dc.containers.get(srv_name)
     port = int(service.attrs['HostConfig']['PortBindings']['29593/tcp'][0]['HostPort'])
 
-    return ManagedService(srv_name, port)
+    srv = ManagedService(srv_name, port)
+    _remember_service(srv)
+    return srv
 
 def require_service(srv_name, srv_type, port=None, user_name=None, password=None):
     """
@@ -214,9 +449,9 @@ def service_to_dict(srv):
         dict: A dictionary with information necessary to rebuild
             the ManagedService object.
     """
-    return {'name': srv._name}
+    return {'name': srv._name, 'port': srv._port}
 
-def service_from_dict(srv_dict):
+def service_from_dict(srv_dict, verify=True):
     """
     Gets a service from a dictionary.
 
@@ -225,6 +460,10 @@ def service_from_dict(srv_dict):
 
     Args:
         srv_dict (dict): A dictionary describing the service.
+        verify (bool): Whether to check with Docker that the service
+            exists. If False, the stored port is trusted and the
+            ManagedService is returned without contacting Docker.
+            Dictionaries without a stored port are always verified.
 
     Returns:
         ManagedService: The service, if it exists.
@@ -232,9 +471,50 @@ def service_from_dict(srv_dict):
     Raises:
         ServiceNotFound: The requested service does not exist.
     """
+    if not verify and 'port' in srv_dict:
+        return ManagedService(srv_dict['name'], srv_dict['port'])
     return get_service(srv_dict['name'])
 
 
+class _ChunkReader:
+    """A minimal read-only file object over an iterable of bytes.
+
+    Lets tarfile read an archive as it arrives from Docker, without
+    collecting it all in memory first.
+    """
+    def __init__(self, chunks):
+        """
+        Create a _ChunkReader.
+
+        Args:
+            chunks (iterable): The bytes objects to read, in order.
+        """
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes, or everything if size is negative.
+
+        Args:
+            size (int): The maximum number of bytes to return.
+
+        Returns:
+            bytes: The data, or b'' at the end of the stream.
+        """
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer.extend(chunk)
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
 class ManagedService(Service):
     """A managed service in a Docker container.
     """
@@ -258,6 +538,19 @@ class ManagedService(Service):
         """str: The name of this service, and its Docker container."""
         self._port = port
         """int: The port number this service runs on."""
+        self._dc = None
+        """docker.DockerClient: Client to use, set on first use."""
+
+    def _docker_client(self):
+        """
+        Returns the Docker client for this service.
+
+        Returns:
+            docker.DockerClient: The shared Docker client.
+        """
+        if self._dc is None:
+            self._dc = _get_docker_client()
+        return self._dc
 
     def is_running(self):
         """
@@ -266,9 +559,9 @@ class ManagedService(Service):
         Returns:
             bool: True iff the service is running.
         """
-        dc = docker.from_env()
-        container = dc.containers.get(self._name)
-        return container.status == 'running'
+        dc = self._docker_client()
+        return bool(dc.api.containers(quiet=True, filters={
+                'name': _name_filter(self._name), 'status': 'running'}))
 
     def start(self):
         """
@@ -276,11 +569,12 @@ class ManagedService(Service):
 
         Does nothing if the service is already running.
         """
-        dc = docker.from_env()
+        dc = self._docker_client()
         container = dc.containers.get(self._name)
         container.start()
-        # Give it some time to start, so subsequent calls work
-        time.sleep(1)
+        # Wait for it to start, so subsequent calls work
+        container.reload()
+        _wait_for_start(container)
 
     def stop(self):
         """
@@ -290,7 +584,7 @@ class ManagedService(Service):
         a clean shutdown. Does nothing if the service is already
         stopped.
         """
-        dc = docker.from_env()
+        dc = self._docker_client()
         container = dc.containers.get(self._name)
         container.stop()
 
@@ -304,14 +598,13 @@ class ManagedService(Service):
         Returns:
             str: The job log
         """
-        dc = docker.from_env()
+        import tarfile
+
+        dc = self._docker_client()
         container = dc.containers.get(self._name)
         stream, stat = container.get_archive('/var/log/cerise/cerise_backend.log')
-        with tempfile.TemporaryFile() as tmp:
-            for chunk in stream:
-                tmp.write(chunk)
-            tmp.seek(0)
-            with tarfile.open(fileobj=tmp) as archive:
-                with archive.extractfile('cerise_backend.log') as logfile:
-                    service_log = logfile.read().decode('utf-8')
+        with tarfile.open(fileobj=_ChunkReader(stream), mode='r|') as archive:
+            # The archive contains only the log file
+            with archive.extractfile(archive.next()) as logfile:
+                service_log = logfile.read().decode('utf-8')
         return service_log
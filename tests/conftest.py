@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import docker
 import pytest
 import random
@@ -6,6 +7,12 @@ import time
 import cerise_manager.service as cs
 
 
+TEST_SERVICE_NAMES = [
+        'cerise_manager_test_service',
+        'cerise_manager_test_service2',
+        'cerise_manager_test_service3']
+
+
 @pytest.fixture(scope='session')
 def docker_client():
     return docker.from_env()
@@ -22,20 +29,23 @@ def clean_up_service(docker_client, srv_name):
 
 @pytest.fixture(scope='session')
 def clean_up(docker_client):
-    clean_up_service(docker_client, 'cerise_manager_test_service')
-    clean_up_service(docker_client, 'cerise_manager_test_service2')
-    clean_up_service(docker_client, 'cerise_manager_test_service3')
+    name_filters = ['^/?{}$'.format(srv_name)
+                    for srv_name in TEST_SERVICE_NAMES]
+    leftovers = docker_client.containers.list(
+        all=True, sparse=True, filters={'name': name_filters})
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(
+            lambda container: container.remove(force=True), leftovers))
 
 
 @pytest.fixture(scope='session')
-def test_image(clean_up):
+def test_image(clean_up, docker_client):
     """Get a plain cerise image for testing.
 
     Ignores errors; we may have a local image available already,
     in which case we want to continue, otherwise the other
     tests will fail.
     """
-    docker_client = docker.from_env()
     try:
         docker_client.images.pull('mdstudio/cerise:develop')
     except docker.errors.APIError:
@@ -1,8 +1,9 @@
 import docker
 import json
 import pytest
+import threading
 import time
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import cerise_manager.service as cs
 import cerise_manager.errors as ce
@@ -24,6 +25,57 @@ def test_get_service(test_container):
     srv = cs.get_service('cerise_manager_test_service')
     assert isinstance(srv, cs.ManagedService)
 
+def test_get_service_twice(test_container):
+    srv0 = cs.get_service('cerise_manager_test_service')
+    srv1 = cs.get_service('cerise_manager_test_service')
+    assert srv0 is srv1
+
+def test_get_service_recreated_while_untracked():
+    # Another client recreated the container on a different port
+    # while we weren't following the event stream
+    container = Mock()
+    container.name = 'cerise_manager_test_service4'
+    container.attrs = {'HostConfig': {'PortBindings': {
+        '29593/tcp': [{'HostPort': '29594'}]}}}
+
+    stream_done = threading.Event()
+
+    def events(**kwargs):
+        stream_done.wait()
+        yield from ()
+
+    dc = Mock()
+    dc.events.side_effect = events
+    dc.api.containers.return_value = [
+            {'Names': ['/cerise_manager_test_service4']}]
+    dc.containers.get.return_value = container
+
+    # Keep hold of the tracker thread, so we can let it finish while
+    # the module state is still patched
+    trackers = []
+    real_thread = threading.Thread
+
+    def make_thread(*args, **kwargs):
+        thread = real_thread(*args, **kwargs)
+        trackers.append(thread)
+        return thread
+
+    old_srv = cs.ManagedService('cerise_manager_test_service4', 29593)
+    with patch('cerise_manager.service._get_docker_client', return_value=dc), \
+            patch('cerise_manager.service._known_containers', None), \
+            patch.dict('cerise_manager.service._services',
+                       {'cerise_manager_test_service4': old_srv}), \
+            patch('cerise_manager.service.threading.Thread', make_thread):
+        try:
+            srv = cs.get_service('cerise_manager_test_service4')
+        finally:
+            stream_done.set()
+            for thread in trackers:
+                thread.join()
+
+    assert srv is not old_srv
+    assert srv._port == 29594
+
 def test_get_missing_service():
     with pytest.raises(ce.ServiceNotFound):
         cs.get_service('does_not_exist')
@@ -33,6 +85,13 @@ def test_service_from_dict(test_container):
     srv = cs.service_from_dict(service_dict)
     assert isinstance(srv, cs.ManagedService)
 
+def test_service_from_dict_unverified():
+    service_dict = {'name': 'doesnotexist', 'port': 29593}
+    srv = cs.service_from_dict(service_dict, verify=False)
+    assert isinstance(srv, cs.ManagedService)
+    assert srv._name == 'doesnotexist'
+    assert srv._port == 29593
+
 def test_missing_service_from_dict():
     with pytest.raises(ce.ServiceNotFound):
         cs.service_from_dict({'name': 'doesnotexist'})
@@ -73,6 +132,17 @@ def test_create_two_services_and_destroy(test_container, test_port, docker_clien
     with pytest.raises(docker.errors.NotFound):
         docker_client.containers.get('cerise_manager_test_service2')
 
+def test_service_exists_tracks_changes(docker_client, test_container):
+    assert cs.service_exists('cerise_manager_test_service')
+    assert not cs.service_exists('cerise_manager_test_service2')
+
+    srv = cs.create_service('cerise_manager_test_service2',
+            'mdstudio/cerise:develop')
+    assert cs.service_exists('cerise_manager_test_service2')
+
+    cs.destroy_service(srv)
+    assert not cs.service_exists('cerise_manager_test_service2')
+
 def test_create_service_object():
     srv = cs.ManagedService('cerise_manager_test_service', 29593)
     assert srv._name == 'cerise_manager_test_service'
@@ -163,6 +233,7 @@ def test_is_not_running(docker_client, test_container, test_service):
 def test_service_to_dict(test_service, test_port):
     dict_ = cs.service_to_dict(test_service)
     assert dict_['name'] == 'cerise_manager_test_service'
+    assert dict_['port'] == test_port
 
 def test_service_serialisation(test_service, test_port):
     dict_ = cs.service_to_dict(test_service)
@@ -180,3 +251,86 @@ def test_get_log(test_service):
     log = test_service.get_log()
     assert isinstance(log, str) or isinstance(log, unicode)
     assert log != ''
+
+def test_chunk_reader():
+    reader = cs._ChunkReader([b'abc', b'', b'defg', b'h'])
+    assert reader.read(2) == b'ab'
+    assert reader.read(4) == b'cdef'
+    assert reader.read() == b'gh'
+    assert reader.read(1) == b''
+
+def test_wait_for_start_crashed_container():
+    container = Mock()
+    container.status = 'exited'
+    with patch('cerise_manager.service._START_TIMEOUT', 5):
+        start = time.monotonic()
+        cs._wait_for_start(container)
+        assert time.monotonic() - start < 1
+    container.reload.assert_not_called()
+
+def test_track_containers():
+    def events():
+        yield {'Action': 'create', 'Actor': {'Attributes': {'name': 'new'}}}
+        yield {'Action': 'destroy', 'Actor': {'Attributes': {'name': 'gone'}}}
+        yield {'Action': 'rename', 'Actor': {'Attributes': {
+            'name': 'renamed', 'oldName': '/old'}}}
+        yield {'Action': 'die', 'Actor': {'Attributes': {'name': 'stopped'}}}
+        # Record the state before the stream ends and it is reset
+        seen.append((set(cs._known_containers), dict(cs._services)))
+
+    seen = []
+    services = {'gone': cs.ManagedService('gone', 29593),
+                'old': cs.ManagedService('old', 29594)}
+    with patch('cerise_manager.service._known_containers',
+               {'gone', 'old', 'stopped'}), \
+            patch.dict('cerise_manager.service._services', services):
+        cs._track_containers(events())
+        assert cs._known_containers is None
+
+    assert seen == [({'new', 'renamed', 'stopped'}, {})]
+
+def test_track_containers_broken_stream():
+    def events():
+        yield {'Action': 'create', 'Actor': {'Attributes': {'name': 'new'}}}
+        raise ConnectionResetError()
+
+    with patch('cerise_manager.service._known_containers', set()), \
+            patch.dict('cerise_manager.service._services',
+                       {'new': cs.ManagedService('new', 29593)}):
+        cs._track_containers(events())
+        assert cs._known_containers is None
+        assert cs._services == {}
+
+def test_container_exists_single_call():
+    dc = Mock()
+    dc.api.containers.return_value = [{'Id': 'abc'}]
+    with patch('cerise_manager.service._get_docker_client', return_value=dc):
+        assert cs._container_exists('cerise_manager_test_service')
+    assert len(dc.mock_calls) == 1
+
+def test_is_running_single_call():
+    dc = Mock()
+    dc.api.containers.return_value = []
+    with patch('cerise_manager.service._get_docker_client', return_value=dc):
+        srv = cs.ManagedService('cerise_manager_test_service', 29593)
+        assert not srv.is_running()
+    assert len(dc.mock_calls) == 1
+
+def test_known_containers_listing_fails():
+    events = Mock()
+    dc = Mock()
+    dc.events.return_value = events
+    dc.api.containers.side_effect = docker.errors.APIError('listing failed')
+    with patch('cerise_manager.service._get_docker_client', return_value=dc), \
+            patch('cerise_manager.service._known_containers', None):
+        with pytest.raises(docker.errors.APIError):
+            cs._get_known_containers()
+        assert cs._known_containers is None
+    events.close.assert_called_once_with()
+
+def test_remember_destroyed_service():
+    srv = cs.ManagedService('cerise_manager_test_service4', 29593)
+    with patch('cerise_manager.service._known_containers', set()), \
+            patch.dict('cerise_manager.service._services', {}):
+        cs._remember_service(srv)
+        assert 'cerise_manager_test_service4' not in cs._services